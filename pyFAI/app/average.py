@@ -33,7 +33,7 @@ __author__ = "Jerome Kieffer, Picca Frédéric-Emmanuel"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "21/01/2020"
+__date__ = "14/10/2026"
 __status__ = "production"
 
 import os
@@ -89,7 +89,7 @@ def parse_algorithms(options):
             continue
 
         try:
-            algorithm = average.create_algorithm(method, options.cutoff, quantiles)
+            algorithm = average.create_algorithm(method, options.cutoff, quantiles, options.backend)
         except average.AlgorithmCreationError as e:
             logger.warning("Method '%s' skipped: %s", method, e)
             continue
@@ -243,6 +243,13 @@ def main():
                         On EDF files, values from 'counter_pos' can accessed by \
                         using the expected mnemonic. \
                         For example 'counter/bmon'.")
+    parser.add_argument("--backend", dest="backend", default="cpu",
+                        choices=["cpu", "gpu", "auto"],
+                        help="Backend used to average darks, flats and stacks \
+                        of images: 'cpu' (default), 'gpu' (experimental, \
+                        requires cupy) or 'auto' to use the GPU when a CUDA \
+                        device is found. Min, max, sum and mean without \
+                        cutoff always run on the CPU.")
     parser.add_argument("--quiet", dest="verbose", default=None, action="store_false",
                         help="Only error messages are printed out")
     parser.add_argument("args", metavar='FILE', type=str, nargs='+',
@@ -292,6 +299,7 @@ def main():
     if images:
         process = average.Average()
         process.set_observer(observer)
+        process.set_backend(options.backend)
         process.set_images(images)
         process.set_dark(darks)
         process.set_flat(flats)
@@ -29,10 +29,12 @@ __authors__ = ["Jérôme Kieffer", "Valentin Valls"]
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "08/01/2021"
+__date__ = "14/10/2026"
 __status__ = "production"
 
+import os
 import logging
+import math
 import numpy
 import fabio
 import weakref
@@ -52,6 +54,106 @@ if ("hexversion" not in dir(fabio)) or (fabio.hexversion < calc_hexversion(0, 4,
 
 logger = logging.getLogger(__name__)
 
+try:
+    import numba
+except ImportError:
+    logger.debug("Backtrace", exc_info=True)
+    numba = None
+
+try:
+    import numexpr
+except ImportError:
+    logger.debug("Backtrace", exc_info=True)
+    numexpr = None
+
+try:
+    import bottleneck
+except ImportError:
+    logger.debug("Backtrace", exc_info=True)
+    bottleneck = None
+
+try:
+    import cupy
+except ImportError:
+    logger.debug("Backtrace", exc_info=True)
+    cupy = None
+
+if numba is not None:
+
+    # fastmath without the "nnan" and "ninf" flags: a NaN pixel has to
+    # propagate to the result as with numpy
+    _FASTMATH = {"contract", "arcp", "reassoc"}
+
+    @numba.njit(fastmath=_FASTMATH, cache=True)
+    def _welford(values):
+        """Mean and sum of squared differences to the mean of a 1D array,
+        computed in a single pass with the Welford algorithm.
+
+        :param numpy.ndarray values: 1D array
+        :return: 2-tuple (mean, m2)
+        """
+        mean = 0.0
+        m2 = 0.0
+        for i in range(values.size):
+            value = values[i]
+            delta = value - mean
+            mean += delta / (i + 1)
+            m2 += delta * (value - mean)
+        return mean, m2
+
+    @numba.njit(fastmath=_FASTMATH, cache=True)
+    def _kept_mean(values, center, threshold):
+        """Mean of the values of a 1D array which are not further than
+        threshold from the center.
+
+        :param numpy.ndarray values: 1D array
+        :param float center: center of the selection
+        :param float threshold: maximum distance to the center
+        """
+        total = 0.0
+        count = 0
+        for i in range(values.size):
+            value = values[i]
+            if not abs(value - center) > threshold:
+                total += value
+                count += 1
+        return total / max(1, count)
+
+    @numba.njit(parallel=True, fastmath=_FASTMATH, cache=True)
+    def _cutoff_mean(stack, cutoff, out):
+        """Average the frames of each pixel, discarding values further than
+        cutoff*std from the mean, in a single streaming pass per pixel.
+
+        :param numpy.ndarray stack: 2D array of shape (pixel, frame)
+        :param float cutoff: keep all data where (I-mean)/std < cutoff
+        :param numpy.ndarray out: 1D output array of size pixel
+        """
+        npix, nframes = stack.shape
+        for p in numba.prange(npix):
+            mean, m2 = _welford(stack[p])
+            std = math.sqrt(m2 / nframes)
+            out[p] = _kept_mean(stack[p], mean, cutoff * std)
+
+    @numba.njit(parallel=True, fastmath=_FASTMATH, cache=True)
+    def _cutoff_center(stack, center, cutoff, out):
+        """Average the frames of each pixel, discarding values further than
+        cutoff*std from a precomputed center (median, quantiles...).
+
+        :param numpy.ndarray stack: 2D array of shape (pixel, frame)
+        :param numpy.ndarray center: 1D array of size pixel
+        :param float cutoff: keep all data where (I-center)/std < cutoff
+        :param numpy.ndarray out: 1D output array of size pixel
+        """
+        npix, nframes = stack.shape
+        for p in numba.prange(npix):
+            _mean, m2 = _welford(stack[p])
+            std = math.sqrt(m2 / nframes)
+            out[p] = _kept_mean(stack[p], center[p], cutoff * std)
+
+else:
+    _cutoff_mean = None
+    _cutoff_center = None
+
 
 class ImageReductionFilter(object):
     """
@@ -70,6 +172,9 @@ class ImageReductionFilter(object):
         """
         Add an image to the filter.
 
+        The image is only valid during the call, as the caller may reuse the
+        buffer, filters have to copy the data they want to keep.
+
         :param numpy.ndarray image: image to add
         """
         raise NotImplementedError()
@@ -89,6 +194,21 @@ class ImageReductionFilter(object):
         """
         raise NotImplementedError()
 
+    def reduce(self, images):
+        """
+        Add all the images of an iterable to the filter and return the
+        result.
+
+        Filters can specialize it to avoid a method call per image.
+
+        :param images: iterable of numpy.ndarray
+        :return: result filter
+        """
+        add_image = self.add_image
+        for image in images:
+            add_image(image)
+        return self.get_result()
+
 
 class ImageAccumulatorFilter(ImageReductionFilter):
     """
@@ -96,6 +216,10 @@ class ImageAccumulatorFilter(ImageReductionFilter):
     to reduce data step by step into a single merged image.
     """
 
+    _ufunc = None
+    """Binary numpy ufunc accumulating the images in place, if the filter is
+    expressed as one"""
+
     def init(self, max_images=None):
         self._count = 0
         self._accumulated_image = None
@@ -114,10 +238,40 @@ class ImageAccumulatorFilter(ImageReductionFilter):
         Add an image to the filter.
 
         :param numpy.ndarray accumulated_image: image use to accumulate
-            information
+            information, owned by the filter and updated in place
         :param numpy.ndarray added_image: image to add
         """
-        raise NotImplementedError()
+        if accumulated_image is None:
+            return numpy.array(added_image, dtype=numpy.float32)
+        self._update(accumulated_image, added_image)
+        return accumulated_image
+
+    def _update(self, accumulated_image, added_image):
+        """
+        Update in place the accumulated image with a new image.
+
+        :param numpy.ndarray accumulated_image: image use to accumulate
+            information, owned by the filter
+        :param numpy.ndarray added_image: image to add
+        """
+        if self._ufunc is None:
+            raise NotImplementedError()
+        self._ufunc(accumulated_image, added_image, out=accumulated_image)
+
+    def reduce(self, images):
+        images = iter(images)
+        if self._accumulated_image is None:
+            for image in images:
+                self.add_image(image)
+                break
+        # the first image is out of the loop: the accumulated image is
+        # updated in place without dispatch through add_image
+        update = self._update
+        accumulated_image = self._accumulated_image
+        for image in images:
+            update(accumulated_image, image)
+            self._count += 1
+        return self.get_result()
 
     def get_result(self):
         """
@@ -134,37 +288,151 @@ class ImageAccumulatorFilter(ImageReductionFilter):
 
 class MaxAveraging(ImageAccumulatorFilter):
     name = "max"
-
-    def _accumulate(self, accumulated_image, added_image):
-        if accumulated_image is None:
-            return added_image
-        return numpy.maximum(accumulated_image, added_image)
+    _ufunc = numpy.maximum
 
 
 class MinAveraging(ImageAccumulatorFilter):
     name = "min"
-
-    def _accumulate(self, accumulated_image, added_image):
-        if accumulated_image is None:
-            return added_image
-        return numpy.minimum(accumulated_image, added_image)
+    _ufunc = numpy.minimum
 
 
 class SumAveraging(ImageAccumulatorFilter):
     name = "sum"
+    _ufunc = numpy.add
 
-    def _accumulate(self, accumulated_image, added_image):
-        if accumulated_image is None:
-            return added_image
-        return accumulated_image + added_image
 
+class MeanAveraging(ImageAccumulatorFilter):
+    """
+    Running mean updated in place with ``mean += (image - mean) / n``.
 
-class MeanAveraging(SumAveraging):
+    Unlike a float32 sum divided at the end, the accumulated value keeps the
+    magnitude of the data whatever the number of frames.
+    """
     name = "mean"
 
+    def init(self, max_images=None):
+        super(MeanAveraging, self).init(max_images)
+        self._scratch = None
+
+    def _update(self, accumulated_image, added_image):
+        if self._scratch is None:
+            self._scratch = numpy.empty_like(accumulated_image)
+        numpy.subtract(added_image, accumulated_image, out=self._scratch)
+        self._scratch /= numpy.float32(self._count + 1)
+        accumulated_image += self._scratch
+
+    def get_result(self):
+        self._scratch = None
+        return super(MeanAveraging, self).get_result()
+
+
+class ImageChunkedStackFilter(ImageReductionFilter):
+    """
+    Filter buffering images into chunks of limited size, each chunk being
+    folded into running statistics. The memory used does not depend on the
+    number of images.
+    """
+
+    max_chunk_size = 128 * 1024 ** 2
+    """Maximum size of a chunk in bytes"""
+
+    def init(self, max_images=None):
+        self._chunk = None
+        self._max_stack_size = max_images
+        self._chunk_count = 0
+        self._count = 0
+
+    def add_image(self, image):
+        """
+        Add an image to the filter.
+
+        :param numpy.ndarray image: image to add
+        """
+        if self._chunk is None:
+            length = max(1, self.max_chunk_size // (image.size * 4))
+            if self._max_stack_size:
+                length = min(length, self._max_stack_size)
+            # frame-major chunk: each image is a contiguous write
+            shape = length, image.shape[0], image.shape[1]
+            self._chunk = numpy.empty(shape, dtype=numpy.float32)
+        self._chunk[self._chunk_count] = image
+        self._chunk_count += 1
+        self._count += 1
+        if self._chunk_count == self._chunk.shape[0]:
+            self._reduce_chunk(self._chunk)
+            self._chunk_count = 0
+
+    def _reduce_chunk(self, chunk):
+        """Fold a chunk of images into the running statistics.
+
+        :param numpy.ndarray chunk: stack of images, of shape (frame, y, x)
+        """
+        raise NotImplementedError()
+
+    def _compute_result(self):
+        """Called after all the chunks are reduced and return the reduction
+        result."""
+        raise NotImplementedError()
+
     def get_result(self):
-        result = super(MeanAveraging, self).get_result()
-        return result / numpy.float32(self._count)
+        if self._chunk is None:
+            raise Exception("No data to reduce")
+
+        if self._chunk_count > 0:
+            self._reduce_chunk(self._chunk[:self._chunk_count])
+            self._chunk_count = 0
+        result = self._compute_result()
+        # release the allocated memory
+        self._chunk = None
+        return result
+
+
+class StdAveraging(ImageChunkedStackFilter):
+    """
+    Standard deviation of the images.
+
+    Mean and sum of squared differences of each chunk are merged into the
+    running ones with the parallel algorithm of Chan et al.
+    """
+    name = "std"
+
+    def init(self, max_images=None):
+        super(StdAveraging, self).init(max_images)
+        self._mean = None
+        self._m2 = None
+        self._scratch = None
+        self._reduced = 0
+
+    def _reduce_chunk(self, chunk):
+        size = chunk.shape[0]
+        mean = chunk.mean(axis=0)
+        # squared differences to the mean of the chunk, frame per frame,
+        # without a temporary of the size of the chunk
+        if self._scratch is None:
+            self._scratch = numpy.empty_like(mean)
+        m2 = numpy.zeros_like(mean)
+        for frame in chunk:
+            numpy.subtract(frame, mean, out=self._scratch)
+            numpy.multiply(self._scratch, self._scratch, out=self._scratch)
+            m2 += self._scratch
+        # the running statistics are merged in double precision
+        mean = mean.astype(numpy.float64)
+        m2 = m2.astype(numpy.float64)
+        if self._mean is None:
+            self._mean = mean
+            self._m2 = m2
+        else:
+            total = self._reduced + size
+            delta = mean - self._mean
+            self._mean += delta * (size / total)
+            self._m2 += m2
+            self._m2 += delta * delta * (self._reduced * size / total)
+        self._reduced += size
+
+    def _compute_result(self):
+        result = numpy.sqrt(self._m2 / self._reduced).astype(numpy.float32)
+        self._mean = self._m2 = self._scratch = None
+        return result
 
 
 class ImageStackFilter(ImageReductionFilter):
@@ -173,8 +441,16 @@ class ImageStackFilter(ImageReductionFilter):
     end.
     """
 
+    pixel_major = False
+    """If true, the stack is filled as (y, x, frame), else as (frame, y, x)"""
+
+    staging_size = 16
+    """Number of images staged before being copied into a pixel-major stack"""
+
     def init(self, max_images=None):
         self._stack = None
+        self._staging = None
+        self._staged = 0
         self._max_stack_size = max_images
         self._count = 0
 
@@ -185,23 +461,53 @@ class ImageStackFilter(ImageReductionFilter):
         :param numpy.ndarray image: image to add
         """
         if self._stack is None:
-            shape = self._max_stack_size, image.shape[0], image.shape[1]
+            if self.pixel_major:
+                shape = image.shape[0], image.shape[1], self._max_stack_size
+                # a strided write per image is slow: images are staged
+                # frame-major and copied by blocks into the stack
+                staging = min(self.staging_size, self._max_stack_size)
+                self._staging = numpy.empty((staging,) + image.shape, dtype=numpy.float32)
+            else:
+                shape = self._max_stack_size, image.shape[0], image.shape[1]
             self._stack = numpy.zeros(shape, dtype=numpy.float32)
-        self._stack[self._count] = image
         self._count += 1
-
-    def _compute_stack_reduction(self, stack):
+        if self._staging is None:
+            self._stack[self._count - 1] = image
+        else:
+            self._staging[self._staged] = image
+            self._staged += 1
+            if self._staged == len(self._staging):
+                self._flush_staging()
+
+    def _flush_staging(self):
+        """Copy the staged images into the pixel-major stack."""
+        start = self._count - self._staged
+        _fill_pixel_major(self._stack, self._staging[:self._staged], start)
+        self._staged = 0
+
+    def _compute_stack_reduction(self, stack, axis):
         """Called after initialization of the stack and return the reduction
-        result."""
+        result.
+
+        :param numpy.ndarray stack: stack to reduce, of shape (frame, y, x)
+            or (y, x, frame)
+        :param int axis: axis along which the frames are stacked
+        """
         raise NotImplementedError()
 
     def get_result(self):
         if self._stack is None:
             raise Exception("No data to reduce")
 
-        shape = self._count, self._stack.shape[1], self._stack.shape[2]
-        self._stack.resize(shape)
-        result = self._compute_stack_reduction(self._stack)
+        # zero-copy view on the added frames
+        if self.pixel_major:
+            if self._staged > 0:
+                self._flush_staging()
+            # the staged images are no longer needed during the reduction
+            self._staging = None
+            result = self._compute_stack_reduction(self._stack[:, :, :self._count], -1)
+        else:
+            result = self._compute_stack_reduction(self._stack[:self._count], 0)
         # release the allocated memory
         self._stack = None
         return result
@@ -214,11 +520,14 @@ class AverageDarkFilter(ImageStackFilter):
     TODO: Must be split according to each filter_name, and removed
     """
 
-    def __init__(self, filter_name, cut_off, quantiles):
+    def __init__(self, filter_name, cut_off, quantiles, backend="cpu"):
         super(AverageDarkFilter, self).__init__()
         self._filter_name = filter_name
         self._cut_off = cut_off
         self._quantiles = quantiles
+        self._backend = backend
+        # filled in the layout average_dark reduces without copy
+        self.pixel_major = _is_pixel_major_reduction(filter_name, cut_off)
 
     @property
     def name(self):
@@ -228,18 +537,21 @@ class AverageDarkFilter(ImageStackFilter):
         """Return a dictionary containing filter parameters"""
         return {"cutoff": self._cut_off, "quantiles": self._quantiles}
 
-    def _compute_stack_reduction(self, stack):
+    def _compute_stack_reduction(self, stack, axis):
         """
         Compute the stack reduction.
 
         :param numpy.ndarray stack: stack to reduce
+        :param int axis: axis along which the frames are stacked
         :return: result filter
         :rtype: numpy.ndarray
         """
         return average_dark(stack,
                             self._filter_name,
                             self._cut_off,
-                            self._quantiles)
+                            self._quantiles,
+                            axis=axis,
+                            backend=self._backend)
 
 
 _FILTERS = [
@@ -247,6 +559,7 @@ _FILTERS = [
     MinAveraging,
     MeanAveraging,
     SumAveraging,
+    StdAveraging,
 ]
 
 _FILTER_NAME_MAPPING = {}
@@ -271,7 +584,7 @@ class AlgorithmCreationError(RuntimeError):
     pass
 
 
-def create_algorithm(filter_name, cut_off=None, quantiles=None):
+def create_algorithm(filter_name, cut_off=None, quantiles=None, backend="cpu"):
     """Factory to create algorithm according to parameters
 
     :param cutoff: keep all data where (I-center)/std < cutoff
@@ -279,6 +592,9 @@ def create_algorithm(filter_name, cut_off=None, quantiles=None):
     :param quantiles: 2-tuple of floats average out data between the two
         quantiles
     :type quantiles:  tuple(float, float) or None
+    :param str backend: backend used to reduce a stack of images: "cpu",
+        "gpu" (experimental) or "auto". The accumulator filters (min, max,
+        sum, mean without cutoff) always run on the CPU.
     :return: An algorithm
     :rtype: ImageReductionFilter
     :raise AlgorithmCreationError: If it is not possible to create the
@@ -292,7 +608,7 @@ def create_algorithm(filter_name, cut_off=None, quantiles=None):
         # must create a big array with all the data
         if filter_name == "quantiles" and quantiles is None:
             raise AlgorithmCreationError("Quantiles algorithm expect quantiles parameters")
-        algorithm = AverageDarkFilter(filter_name, cut_off, quantiles)
+        algorithm = AverageDarkFilter(filter_name, cut_off, quantiles, backend)
     else:
         raise AlgorithmCreationError("No algorithm available for the expected parameters")
 
@@ -388,7 +704,89 @@ def remove_saturated_pixel(ds, threshold=0.1, minimum=None, maximum=None):
     return ds
 
 
-def average_dark(lstimg, center_method="mean", cutoff=None, quantiles=(0.5, 0.5)):
+def _fill_pixel_major(stack, images, start=0, block_size=512 * 1024):
+    """Copy 2D images into consecutive frames of a pixel-major stack of
+    shape (y, x, frame).
+
+    The stack is filled by blocks of rows, so that the strided writes of
+    each image stay in cache.
+
+    :param numpy.ndarray stack: pixel-major stack
+    :param images: sequence of 2D images of the same shape
+    :param int start: index of the first frame to fill
+    :param int block_size: size in bytes of a block of rows of the stack
+    """
+    length = len(images)
+    rows = max(1, block_size // (stack.shape[1] * length * 4))
+    for row in range(0, stack.shape[0], rows):
+        block = stack[row:row + rows, :, start:start + length]
+        for i, image in enumerate(images):
+            block[:, :, i] = image[row:row + rows]
+
+
+def _pixel_major_stack(images):
+    """Copy a list of 2D images into a float32 stack of shape (y, x, frame).
+
+    :param images: list of 2D images of the same shape
+    :rtype: numpy.ndarray
+    """
+    shape = images[0].shape
+    stack = numpy.empty((shape[0], shape[1], len(images)), dtype=numpy.float32)
+    _fill_pixel_major(stack, images)
+    return stack
+
+
+def _is_pixel_major_reduction(center_method, cutoff):
+    """Returns true if `average_dark` reduces a pixel-major stack
+    (y, x, frame) faster than a frame-major one (frame, y, x).
+
+    Sort, median and the numba kernels are faster on a pixel-major stack
+    while numpy mean, std... are faster on a frame-major one.
+
+    :param str center_method: method used by `average_dark`
+    :param cutoff: cutoff used by `average_dark`
+    :rtype: bool
+    """
+    if cutoff is not None and cutoff > 0 and numba is not None:
+        return True
+    return center_method == "median" or center_method.startswith("quantil")
+
+
+def _quantile_bounds(quantiles, length):
+    """Return the range of sorted frames to average out between two
+    quantiles.
+
+    :param quantiles: 2-tuple of floats
+    :param int length: number of frames
+    :return: 2-tuple (lower, upper)
+    """
+    lower = max(0, int(numpy.floor(min(quantiles) * length)))
+    upper = min(length, int(numpy.ceil(max(quantiles) * length)))
+    if (upper == lower):
+        if upper < length:
+            upper += 1
+        elif lower > 0:
+            lower -= 1
+        else:
+            logger.warning("Empty selection for quantil %s, would keep points from %s to %s", quantiles, lower, upper)
+    return lower, upper
+
+
+def _cuda_available():
+    """Returns true if cupy is available and finds a CUDA device.
+
+    :rtype: bool
+    """
+    if cupy is None:
+        return False
+    try:
+        return cupy.cuda.runtime.getDeviceCount() > 0
+    except Exception:
+        logger.debug("Backtrace", exc_info=True)
+        return False
+
+
+def average_dark(lstimg, center_method="mean", cutoff=None, quantiles=(0.5, 0.5), axis=0, backend="cpu"):
     """
     Averages a series of dark (or flat) images.
     Centers the result on the mean or the median ...
@@ -402,74 +800,203 @@ def average_dark(lstimg, center_method="mean", cutoff=None, quantiles=(0.5, 0.5)
     :param quantiles: 2-tuple of floats average out data between the two
         quantiles
     :type quantiles:  tuple(float, float) or None
+    :param int axis: axis of the 3D stack along which frames are stacked,
+        0 for (frame, y, x), -1 for a pixel-major stack (y, x, frame).
+        Median, quantiles and the numba cutoff kernels are faster on a
+        pixel-major stack: a frame-major one is transposed into a float32
+        copy of the whole stack for them, which doubles the memory used.
+        Pass a pixel-major stack to avoid it. Ignored for a list of
+        images.
+    :param str backend: "cpu", "gpu" (experimental, requires cupy) or
+        "auto" to use the GPU when cupy finds a CUDA device
     :return: 2D image averaged
     """
+    if backend == "auto":
+        backend = "gpu" if _cuda_available() else "cpu"
+    if backend == "gpu":
+        return average_dark_gpu(lstimg, center_method, cutoff, quantiles, axis)
+    elif backend != "cpu":
+        raise RuntimeError("Cannot understand backend: %s in average_dark" % backend)
+    return _average_dark(numpy, lstimg, center_method, cutoff, quantiles, axis)
+
+
+def average_dark_gpu(lstimg, center_method="mean", cutoff=None, quantiles=(0.5, 0.5), axis=0):
+    """
+    Same as `average_dark` but the stack is reduced on the GPU using cupy.
+
+    Experimental: this code path was not run on a CUDA device yet. The
+    stack is built on the host and uploaded in a single transfer, and the
+    device memory pool is released once the result is retrieved.
+
+    :param lstimg: list of 2D images or a 3D stack
+    :param str center_method: is the center calculated by a "mean", "median",
+        "quantile", "std"
+    :param cutoff: keep all data where (I-center)/std < cutoff
+    :type cutoff:  float or None
+    :param quantiles: 2-tuple of floats average out data between the two
+        quantiles
+    :type quantiles:  tuple(float, float) or None
+    :param int axis: axis of the 3D stack along which frames are stacked.
+        Ignored for a list of images.
+    :return: 2D image averaged
+    """
+    if cupy is None:
+        raise RuntimeError("GPU averaging requires the *cupy* package")
+    output = None
+    try:
+        output = _average_dark(cupy, lstimg, center_method, cutoff, quantiles, axis)
+        return cupy.asnumpy(output)
+    finally:
+        # drop the reference to the device array so that its block is released
+        output = None
+        cupy.get_default_memory_pool().free_all_blocks()
+
+
+def _average_dark(xp, lstimg, center_method, cutoff, quantiles, axis):
+    """
+    Implementation of `average_dark` using the array module `xp`.
+
+    The numba kernels, bottleneck and numexpr are only used with numpy;
+    any other module (cupy) gets the generic array implementation.
+
+    :param module xp: numpy or cupy
+    :return: 2D image averaged, as an array of `xp`
+    """
+    accelerated = xp is numpy
+    cut = cutoff is not None and cutoff > 0
+    use_kernel = cut and accelerated and numba is not None
+    pixel_major = accelerated and _is_pixel_major_reduction(center_method, cutoff)
     if "ndim" in dir(lstimg) and lstimg.ndim == 3:
-        stack = lstimg.astype(numpy.float32)
-        shape = stack.shape[1:]
-        length = stack.shape[0]
+        axis = axis % 3
+        if lstimg.shape[axis] == 1:
+            return xp.array(lstimg[(slice(None),) * axis + (0,)], dtype=numpy.float32)
+        if pixel_major and axis != 2:
+            # a single transposition is cheaper than strided reductions,
+            # at the cost of a copy of the stack
+            stack = numpy.moveaxis(numpy.asarray(lstimg), axis, -1)
+            stack = numpy.ascontiguousarray(stack, dtype=numpy.float32)
+            axis = 2
+        elif cut and not use_kernel:
+            # only the array implementation of the cutoff modifies the stack
+            stack = xp.array(lstimg, dtype=numpy.float32)
+        else:
+            stack = xp.asarray(lstimg, dtype=numpy.float32)
+        length = stack.shape[axis]
     else:
         shape = lstimg[0].shape
         length = len(lstimg)
         if length == 1:
-            return lstimg[0].astype(numpy.float32)
-        stack = numpy.zeros((length, shape[0], shape[1]), dtype=numpy.float32)
-        for i, img in enumerate(lstimg):
-            stack[i] = img
+            return xp.array(lstimg[0], dtype=numpy.float32)
+        if pixel_major:
+            stack = _pixel_major_stack(lstimg)
+            axis = 2
+        else:
+            # the stack is allocated once and filled image per image
+            stack = xp.empty((length, shape[0], shape[1]), dtype=numpy.float32)
+            for i, img in enumerate(lstimg):
+                stack[i] = xp.asarray(img)
+            axis = 0
+    if use_kernel and center_method == "mean":
+        # fused kernel: a single pass over the stack without temporary arrays
+        frames = numpy.moveaxis(stack, axis, -1)
+        output = numpy.empty(frames.shape[:-1], dtype=numpy.float32)
+        _cutoff_mean(frames.reshape(-1, length), cutoff, output.reshape(-1))
+        return output
     if center_method in dir(stack):
-        center = stack.__getattribute__(center_method)(axis=0)
+        center = stack.__getattribute__(center_method)(axis=axis)
     elif center_method == "median":
         logger.info("Filtering data (median)")
-        center = numpy.median(stack, axis=0)
+        if accelerated and bottleneck is not None:
+            center = bottleneck.median(stack, axis=axis)
+        else:
+            center = xp.median(stack, axis=axis)
     elif center_method.startswith("quantil"):
         logger.info("Filtering data (quantiles: %s)", quantiles)
-        sorted_ = numpy.sort(stack, axis=0)
-        lower = max(0, int(numpy.floor(min(quantiles) * length)))
-        upper = min(length, int(numpy.ceil(max(quantiles) * length)))
-        if (upper == lower):
-            if upper < length:
-                upper += 1
-            elif lower > 0:
-                lower -= 1
-            else:
-                logger.warning("Empty selection for quantil %s, would keep points from %s to %s", quantiles, lower, upper)
-        center = sorted_[lower:upper].mean(axis=0)
+        lower, upper = _quantile_bounds(quantiles, length)
+        # sort is SIMD accelerated, faster than a partition on 2 pivots
+        sorted_ = xp.moveaxis(xp.sort(stack, axis=axis), axis, 0)
+        center = sorted_[lower:upper].mean(axis=0, dtype=numpy.float32)
     else:
         raise RuntimeError("Cannot understand method: %s in average_dark" % center_method)
-    if cutoff is None or cutoff <= 0:
+    if not cut:
         output = center
+    elif use_kernel:
+        frames = numpy.moveaxis(stack, axis, -1)
+        output = numpy.empty(frames.shape[:-1], dtype=numpy.float32)
+        center = numpy.ascontiguousarray(center, dtype=numpy.float32)
+        _cutoff_center(frames.reshape(-1, length), center.reshape(-1), cutoff, output.reshape(-1))
     else:
-        std = stack.std(axis=0)
-        strides = 0, std.strides[0], std.strides[1]
-        std.shape = 1, shape[0], shape[1]
-        std.strides = strides
-        center.shape = 1, shape[0], shape[1]
-        center.strides = strides
-        mask = ((abs(stack - center) / std) > cutoff)
-        stack[numpy.where(mask)] = 0.0
-        summed = stack.sum(axis=0)
-        output = summed / numpy.float32(numpy.maximum(1, (length - mask.sum(axis=0))))
+        # (I-center)/std > cutoff, broadcast along the frames
+        threshold = xp.expand_dims(cutoff * stack.std(axis=axis), axis)
+        center = xp.expand_dims(center, axis)
+        if accelerated and numexpr is not None:
+            # no floating point temporary of the size of the stack
+            mask = numexpr.evaluate("abs(stack - center) > threshold")
+        else:
+            mask = xp.abs(stack - center) > threshold
+        # masked write, without building the tuple of indices
+        xp.copyto(stack, 0.0, where=mask)
+        summed = stack.sum(axis=axis)
+        output = summed / xp.maximum(1, (length - mask.sum(axis=axis))).astype(numpy.float32)
     return output
 
 
-def _normalize_image_stack(image_stack):
+def _normalize_image_stack(image_stack, pixel_major=False):
     """
     Convert input data to a list of 2D numpy arrays or a stack
     of numpy array (3D array).
 
+    A list of filenames or of 2D arrays is copied into a single float32
+    stack, filled one image at a time, with the frames stacked along the
+    axis the reduction is the fastest on. All the images must have the same
+    shape.
+
     :param image_stack: slice of images
     :type image_stack: list or numpy.ndarray
-    :return: A stack of image (list of 2D array or a single 3D array)
-    :rtype: list or numpy.ndarray
+    :param bool pixel_major: if true, images are stacked as (y, x, frame),
+        else as (frame, y, x)
+    :return: A stack of image (list of 2D array or a single 3D array) and the
+        axis along which the frames are stacked
+    :rtype: tuple(list or numpy.ndarray, int)
     """
     if image_stack is None:
-        return None
+        return None, 0
 
     if isinstance(image_stack, numpy.ndarray) and image_stack.ndim == 3:
         # numpy image stack (single 3D image)
-        return image_stack
+        return image_stack, 0
 
     if isinstance(image_stack, list):
+        if len(image_stack) > 0 and all(isinstance(image, (str,)) for image in image_stack):
+            # files are read one at a time, straight into the stack
+            data = read_data(image_stack[0])
+            if pixel_major:
+                result = numpy.empty(data.shape + (len(image_stack),), dtype=numpy.float32)
+                frames = numpy.moveaxis(result, -1, 0)
+            else:
+                result = numpy.empty((len(image_stack),) + data.shape, dtype=numpy.float32)
+                frames = result
+            for index, image in enumerate(image_stack):
+                if index > 0:
+                    data = read_data(image)
+                if data.shape != frames.shape[1:]:
+                    raise Exception("Image '%s' has shape %s, expected %s" % (image, data.shape, frames.shape[1:]))
+                frames[index] = data
+            return result, (-1 if pixel_major else 0)
+
+        if len(image_stack) > 0 and all(isinstance(image, numpy.ndarray) and image.ndim == 2 for image in image_stack):
+            shape = image_stack[0].shape
+            for index, image in enumerate(image_stack):
+                if image.shape != shape:
+                    raise Exception("Image %i has shape %s, expected %s" % (index, image.shape, shape))
+            # a single copy into a float32 stack, converting the dtype on the fly
+            if pixel_major:
+                return _pixel_major_stack(image_stack), -1
+            result = numpy.empty((len(image_stack),) + shape, dtype=numpy.float32)
+            for index, image in enumerate(image_stack):
+                result[index] = image
+            return result, 0
+
         # list of numpy images (multi 2D images)
         result = []
         for image in image_stack:
@@ -480,7 +1007,7 @@ def _normalize_image_stack(image_stack):
             else:
                 raise Exception("Unsupported image type '%s' in image_stack" % type(image))
             result.append(data)
-        return result
+        return result, 0
 
     raise Exception("Unsupported type '%s' for image_stack" % type(image_stack))
 
@@ -585,19 +1112,7 @@ def common_prefix(string_list):
     :param list(str) string_list: List of strings
     :rtype: str
     """
-    prefix = ""
-    for ch in zip(string_list):
-        c = ch[0]
-        good = True
-        for i in ch:
-            if i != c:
-                good = False
-                break
-        if good:
-            prefix += c
-        else:
-            break
-    return prefix
+    return os.path.commonprefix(list(string_list))
 
 
 class AverageObserver(object):
@@ -639,6 +1154,9 @@ class Average(object):
         self._dark = None
         self._raw_flat = None
         self._flat = None
+        self._corrections = None, None
+        self._scratch = None
+        self._backend = "cpu"
         self._monitor_key = None
         self._threshold = None
         self._minimum = None
@@ -649,6 +1167,7 @@ class Average(object):
         self._nb_frames = 0
         self._correct_flat_from_dark = False
         self._results = weakref.WeakKeyDictionary()
+        self._monitors = weakref.WeakKeyDictionary()
         self._observer = None
 
     def set_observer(self, observer):
@@ -658,6 +1177,16 @@ class Average(object):
         """
         self._observer = observer
 
+    def set_backend(self, backend):
+        """Defines the backend used to average the darks and the flats.
+
+        It only applies to the following calls to `set_dark` and `set_flat`,
+        algorithms are created with their own backend.
+
+        :param str backend: "cpu", "gpu" (experimental) or "auto"
+        """
+        self._backend = backend
+
     def set_dark(self, dark_list):
         """Defines images used as dark.
 
@@ -666,8 +1195,9 @@ class Average(object):
         if dark_list is None:
             self._dark = None
             return
-        darks = _normalize_image_stack(dark_list)
-        self._dark = average_dark(darks, center_method="mean", cutoff=4)
+        pixel_major = _is_pixel_major_reduction("mean", 4)
+        darks, axis = _normalize_image_stack(dark_list, pixel_major)
+        self._dark = average_dark(darks, center_method="mean", cutoff=4, axis=axis, backend=self._backend)
 
     def set_flat(self, flat_list):
         """Defines images used as flat.
@@ -677,8 +1207,9 @@ class Average(object):
         if flat_list is None:
             self._raw_flat = None
             return
-        flats = _normalize_image_stack(flat_list)
-        self._raw_flat = average_dark(flats, center_method="mean", cutoff=4)
+        pixel_major = _is_pixel_major_reduction("mean", 4)
+        flats, axis = _normalize_image_stack(flat_list, pixel_major)
+        self._raw_flat = average_dark(flats, center_method="mean", cutoff=4, axis=axis, backend=self._backend)
 
     def set_correct_flat_from_dark(self, correct_flat_from_dark):
         """Defines if the dark must be applied on the flat.
@@ -707,6 +1238,7 @@ class Average(object):
             used as source for the computation.
         """
         self._fabio_images = []
+        self._monitors.clear()
         self._nb_frames = 0
         if len(image_list) > 100:
             # if too many files are opened, it may crash. The hard limit is 1024
@@ -755,6 +1287,7 @@ class Average(object):
         """
 
         self._monitor_key = monitor_name
+        self._monitors.clear()
 
     def set_pixel_filter(self, threshold, minimum, maximum):
         """Defines the filter applied on each pixels of the images before
@@ -782,31 +1315,114 @@ class Average(object):
         """
         self._algorithms.append(algorithm)
 
-    def _get_corrected_image(self, fabio_image, image):
+    def _get_monitor(self, fabio_image):
+        """Returns the monitor value of an image. The header is only parsed
+        the first time, the value is cached for the following frames and
+        algorithms.
+
+        :param fabio.fabioimage.FabioImage fabio_image: Object containing the
+            header of the data to process
+        :rtype: float
+        :raise header_utils.MonitorNotFound: when the expected monitor is not
+            found on the header
+        """
+        try:
+            monitor = self._monitors[fabio_image]
+        except KeyError:
+            try:
+                monitor = header_utils.get_monitor_value(fabio_image, self._monitor_key)
+            except header_utils.MonitorNotFound as e:
+                # only the message is cached: the exception would keep its
+                # traceback, and so the image, alive
+                monitor = str(e)
+            self._monitors[fabio_image] = monitor
+        if isinstance(monitor, str):
+            raise header_utils.MonitorNotFound(monitor)
+        return monitor
+
+    def _get_corrected_image(self, fabio_image, image, out=None):
         """Returns an image corrected by pixel filter, saturation, flat, dark,
         and monitor correction. The internal computation is done in float
-        64bits. The result is provided as float 32 bits.
+        64bits in a scratch buffer reused for all the frames. The result is
+        provided as float 32 bits.
 
         :param fabio.fabioimage.FabioImage fabio_image: Object containing the
             header of the data to process
         :param numpy.ndarray image: Data to process
+        :param numpy.ndarray out: Buffer used to store the result. A new one
+            is allocated if None or if its shape do not match.
         :rtype: numpy.ndarray
         """
-        corrected_image = numpy.ascontiguousarray(image, numpy.float64)
-        if self._threshold or self._minimum or self._maximum:
-            corrected_image = remove_saturated_pixel(corrected_image, self._threshold, self._minimum, self._maximum)
-        if self._dark is not None:
-            corrected_image -= self._dark
-        if self._flat is not None:
-            corrected_image /= self._flat
+        monitor = None
         if self._monitor_key is not None:
             try:
-                monitor = header_utils.get_monitor_value(fabio_image, self._monitor_key)
-                corrected_image /= monitor
+                monitor = self._get_monitor(fabio_image)
             except header_utils.MonitorNotFound as e:
                 logger.warning("Monitor not found in filename '%s', data skipped. Cause: %s", fabio_image.filename, str(e))
                 return None
-        return numpy.ascontiguousarray(corrected_image, numpy.float32)
+        scratch = None
+        if self._threshold or self._minimum or self._maximum:
+            # remove_saturated_pixel works in place
+            scratch = numpy.array(image, dtype=numpy.float64)
+            image = remove_saturated_pixel(scratch, self._threshold, self._minimum, self._maximum)
+        if out is None or out.shape != image.shape:
+            out = numpy.empty(image.shape, dtype=numpy.float32)
+        if self._dark is None and self._flat is None and monitor is None:
+            if image.dtype == numpy.float32 and image.flags.c_contiguous:
+                return image
+            numpy.copyto(out, image, casting="unsafe")
+            return out
+
+        if scratch is None:
+            if self._scratch is None or self._scratch.shape != image.shape:
+                self._scratch = numpy.empty(image.shape, dtype=numpy.float64)
+            scratch = self._scratch
+            numpy.copyto(scratch, image, casting="unsafe")
+        dark, flat = self._corrections
+        if dark is not None:
+            scratch -= dark
+        if flat is not None:
+            scratch /= flat
+        if monitor is not None:
+            scratch /= monitor
+        numpy.copyto(out, scratch, casting="unsafe")
+        return out
+
+    def _iter_corrected_images(self, algorithm):
+        """Iterates over the corrected frames of all the source images.
+
+        The same buffer is reused for all the frames: each image is only
+        valid until the next one is requested.
+
+        :param ImageReductionFilter algorithm: Averaging algorithm for which
+            the frames are provided, used to notify the observer
+        :rtype: Iterator[numpy.ndarray]
+        """
+        frame_index = 0
+        # buffer reused for the correction of each frame
+        buffer = None
+        # data.min() and data.max() are full passes over the frame
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for fabio_image in self._fabio_images:
+            # nframes may be a property parsing the headers
+            nframes = fabio_image.nframes
+            if nframes == 1:
+                frames = [fabio_image.data]
+            else:
+                getframe = fabio_image.getframe
+                frames = (getframe(frame).data for frame in range(nframes))
+            for frame, data in enumerate(frames):
+                if debug:
+                    logger.debug("Intensity range for %s#%i is %s --> %s", fabio_image.filename, frame, data.min(), data.max())
+
+                corrected_image = self._get_corrected_image(fabio_image, data, out=buffer)
+                if corrected_image is not None:
+                    if corrected_image is not data:
+                        buffer = corrected_image
+                    yield corrected_image
+                if self._observer:
+                    self._observer.frame_processed(algorithm, frame_index, self._nb_frames)
+                frame_index += 1
 
     def _get_image_reduction(self, algorithm):
         """Returns the result of an averaging algorithm using all over
@@ -816,24 +1432,10 @@ class Average(object):
         :rtype: numpy.ndarray
         """
         algorithm.init(max_images=self._nb_frames)
-        frame_index = 0
-        for fabio_image in self._fabio_images:
-            for frame in range(fabio_image.nframes):
-                if fabio_image.nframes == 1:
-                    data = fabio_image.data
-                else:
-                    data = fabio_image.getframe(frame).data
-                logger.debug("Intensity range for %s#%i is %s --> %s", fabio_image.filename, frame, data.min(), data.max())
-
-                corrected_image = self._get_corrected_image(fabio_image, data)
-                if corrected_image is not None:
-                    algorithm.add_image(corrected_image)
-                if self._observer:
-                    self._observer.frame_processed(algorithm, frame_index, self._nb_frames)
-                frame_index += 1
+        result = algorithm.reduce(self._iter_corrected_images(algorithm))
         if self._observer:
             self._observer.result_processing(algorithm)
-        return algorithm.get_result()
+        return result
 
     def _update_flat(self):
         """
@@ -852,6 +1454,10 @@ class Average(object):
         else:
             flat = None
         self._flat = flat
+        # dark and flat stay float32: the in-place ufuncs promote them exactly
+        # to the float64 scratch buffer, reading half the memory
+        self._corrections = tuple(None if array is None else numpy.ascontiguousarray(array, dtype=numpy.float32)
+                                  for array in (self._dark, self._flat))
 
     def process(self):
         """Process source images to all defined averaging algorithms defined
@@ -879,6 +1485,9 @@ class Average(object):
             if self._observer:
                 self._observer.algorithm_finished(algorithm)
 
+        # release the correction buffer
+        self._scratch = None
+
         if self._observer:
             self._observer.process_finished()
 
@@ -898,7 +1507,7 @@ class Average(object):
 def average_images(listImages, output=None, threshold=0.1, minimum=None,
                    maximum=None, darks=None, flats=None, filter_="mean",
                    correct_flat_from_dark=False, cutoff=None, quantiles=None,
-                   fformat="edf", monitor_key=None):
+                   fformat="edf", monitor_key=None, backend="cpu"):
     """
     Takes a list of filenames and create an average frame discarding all
         saturated pixels.
@@ -919,6 +1528,9 @@ def average_images(listImages, output=None, threshold=0.1, minimum=None,
         to average out.
     :param fformat: file format of the output image, default: edf
     :param monitor_key str: Key containing the monitor. Can be none.
+    :param str backend: backend used to average darks, flats and stacks of
+        images: "cpu" (default), "gpu" (experimental, requires cupy) or
+        "auto"
     :return: filename with the data or the data ndarray in case format=None
     """
 
@@ -932,6 +1544,7 @@ def average_images(listImages, output=None, threshold=0.1, minimum=None,
         filter_ = "quantiles"
 
     average = Average()
+    average.set_backend(backend)
     average.set_images(listImages)
     average.set_dark(darks)
     average.set_flat(flats)
@@ -939,7 +1552,7 @@ def average_images(listImages, output=None, threshold=0.1, minimum=None,
     average.set_monitor_name(monitor_key)
     average.set_pixel_filter(threshold, minimum, maximum)
 
-    algorithm = create_algorithm(filter_, cutoff, quantiles)
+    algorithm = create_algorithm(filter_, cutoff, quantiles, backend)
     average.add_algorithm(algorithm)
 
     # define writer
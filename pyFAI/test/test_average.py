@@ -33,9 +33,10 @@ __author__ = "Jérôme Kieffer"
 __contact__ = "Jerome.Kieffer@ESRF.eu"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
-__date__ = "16/10/2020"
+__date__ = "14/10/2026"
 
 import unittest
+import unittest.mock
 import numpy
 import os
 import logging
@@ -86,6 +87,140 @@ class TestAverage(unittest.TestCase):
         six = average.average_dark([numpy.ones_like(self.dark), self.dark, numpy.zeros_like(self.dark), self.dark, self.dark], "median", .001)
         self.assertTrue(abs(self.dark - six).max() < 1e-4, "data are the same: test threshold")
 
+    def test_average_dark_axis(self):
+        """Frame-major and pixel-major stacks give the same result"""
+        images = [numpy.random.random((16, 8)).astype(numpy.float32) for _ in range(7)]
+        frame_major = numpy.array(images)
+        pixel_major = numpy.ascontiguousarray(numpy.moveaxis(frame_major, 0, -1))
+        for method, cutoff, quantiles in [("mean", None, None),
+                                          ("median", None, None),
+                                          ("std", None, None),
+                                          ("quantiles", None, (0.2, 0.8)),
+                                          ("mean", 1.0, None),
+                                          ("median", 1.0, None)]:
+            expected = average.average_dark(frame_major, method, cutoff, quantiles)
+            result = average.average_dark(pixel_major, method, cutoff, quantiles, axis=-1)
+            numpy.testing.assert_array_almost_equal(result, expected, decimal=5, err_msg=method)
+            result = average.average_dark(images, method, cutoff, quantiles)
+            numpy.testing.assert_array_almost_equal(result, expected, decimal=5, err_msg=method)
+
+    def test_pixel_major_stack(self):
+        images = [numpy.random.random((7, 5)) for _ in range(3)]
+        stack = average._pixel_major_stack(images)
+        self.assertEqual(stack.dtype, numpy.float32)
+        numpy.testing.assert_array_almost_equal(stack, numpy.moveaxis(numpy.array(images), 0, -1))
+        # several blocks of rows, in the middle of the stack
+        stack = numpy.zeros((7, 5, 5), dtype=numpy.float32)
+        average._fill_pixel_major(stack, images, start=1, block_size=2 * 5 * 3 * 4)
+        numpy.testing.assert_array_almost_equal(stack[:, :, 1:4], numpy.moveaxis(numpy.array(images), 0, -1))
+        numpy.testing.assert_array_equal(stack[:, :, 0], 0)
+        numpy.testing.assert_array_equal(stack[:, :, 4], 0)
+
+    def test_cutoff_mean_kernel(self):
+        if average._cutoff_mean is None:
+            self.skipTest("numba is not available")
+        stack = numpy.random.random((50, 9)).astype(numpy.float32)
+        stack[5, 3] = 100
+        data = stack.astype(numpy.float64)
+        mean = data.mean(axis=-1)[:, None]
+        std = data.std(axis=-1)[:, None]
+        mask = (abs(data - mean) / std) > 1.5
+        expected = numpy.where(mask, 0, data).sum(axis=-1) / numpy.maximum(1, (~mask).sum(axis=-1))
+        result = numpy.empty(50, dtype=numpy.float32)
+        average._cutoff_mean(stack, 1.5, result)
+        numpy.testing.assert_array_almost_equal(result, expected, decimal=5)
+
+    def test_cutoff_center_kernel(self):
+        if average._cutoff_center is None:
+            self.skipTest("numba is not available")
+        stack = numpy.random.random((50, 9)).astype(numpy.float32)
+        stack[5, 3] = 100
+        center = numpy.median(stack, axis=-1)
+        data = stack.astype(numpy.float64)
+        std = data.std(axis=-1)[:, None]
+        mask = (abs(data - center[:, None]) / std) > 1.5
+        expected = numpy.where(mask, 0, data).sum(axis=-1) / numpy.maximum(1, (~mask).sum(axis=-1))
+        result = numpy.empty(50, dtype=numpy.float32)
+        average._cutoff_center(stack, center, 1.5, result)
+        numpy.testing.assert_array_almost_equal(result, expected, decimal=5)
+
+        # a NaN pixel gives NaN, as the numpy implementation
+        stack[7, 2] = numpy.nan
+        center = numpy.median(stack, axis=-1)
+        average._cutoff_center(stack, center, 1.0, result)
+        self.assertTrue(numpy.isnan(result[7]))
+        self.assertFalse(numpy.isnan(result[6]))
+        average._cutoff_mean(stack, 1.0, result)
+        self.assertTrue(numpy.isnan(result[7]))
+        self.assertFalse(numpy.isnan(result[6]))
+        stack = numpy.moveaxis(stack.reshape(5, 10, 9), -1, 0)
+        for method in ("mean", "median"):
+            result = average.average_dark(stack, method, 1.0)
+            self.assertTrue(numpy.isnan(result[0, 7]), method)
+            self.assertFalse(numpy.isnan(result[0, 6]), method)
+
+    def test_average_dark_single_frame(self):
+        image = numpy.random.random((4, 3))
+        for stack, axis in [(image[None], 0), (image[:, :, None], -1), ([image], 0)]:
+            for method, cutoff in [("mean", 4), ("median", None)]:
+                result = average.average_dark(stack, method, cutoff, axis=axis)
+                self.assertEqual(result.dtype, numpy.float32)
+                numpy.testing.assert_array_almost_equal(result, image)
+
+    def test_average_dark_preserves_stack(self):
+        stack = numpy.random.random((5, 16, 8)).astype(numpy.float32)
+        stack[2, 3, 4] = 100
+        reference = stack.copy()
+        for method in ("mean", "median", "quantiles"):
+            average.average_dark(stack, method, cutoff=1.0, quantiles=(0.2, 0.8))
+            numpy.testing.assert_array_equal(stack, reference, err_msg=method)
+
+    def test_average_dark_backend(self):
+        images = [numpy.random.random((16, 8)).astype(numpy.float32) for _ in range(5)]
+        self.assertRaises(RuntimeError, average.average_dark, images, backend="foo")
+
+        # "auto" falls back on the CPU when cupy does not find any device
+        cupy = unittest.mock.MagicMock()
+        cupy.cuda.runtime.getDeviceCount.side_effect = RuntimeError("no CUDA-capable device is detected")
+        with unittest.mock.patch.object(average, "cupy", cupy):
+            result = average.average_dark(images, "median", backend="auto")
+        numpy.testing.assert_array_equal(result, average.average_dark(images, "median"))
+        cupy.get_default_memory_pool.assert_not_called()
+
+        # the generic array implementation used with cupy, run with numpy
+        xp = type(numpy)("xp")
+        xp.__dict__.update(numpy.__dict__)
+        for method, cutoff, quantiles in [("mean", None, None),
+                                          ("mean", 1.0, None),
+                                          ("median", 1.0, None),
+                                          ("quantiles", None, (0.2, 0.8))]:
+            expected = average.average_dark(images, method, cutoff, quantiles)
+            result = average._average_dark(xp, images, method, cutoff, quantiles, 0)
+            numpy.testing.assert_array_almost_equal(result, expected, decimal=5, err_msg=method)
+            result = average._average_dark(xp, numpy.array(images), method, cutoff, quantiles, 0)
+            numpy.testing.assert_array_almost_equal(result, expected, decimal=5, err_msg=method)
+
+        if not average._cuda_available():
+            self.skipTest("cupy is not available or finds no CUDA device")
+        for method, cutoff, quantiles in [("mean", None, None),
+                                          ("median", 1.0, None),
+                                          ("quantiles", None, (0.2, 0.8))]:
+            expected = average.average_dark(images, method, cutoff, quantiles)
+            result = average.average_dark(images, method, cutoff, quantiles, backend="gpu")
+            numpy.testing.assert_array_almost_equal(result, expected, decimal=5, err_msg=method)
+
+    def test_average_images_backend(self):
+        images = [numpy.random.random((16, 8)).astype(numpy.float32) for _ in range(5)]
+        with unittest.mock.patch.object(average, "average_dark", wraps=average.average_dark) as mocked:
+            result = average.average_images(images, darks=[self.dark[:16, :8]], threshold=0, filter_="median", fformat=None, backend="auto")
+        # the dark and the stack of images
+        self.assertEqual(mocked.call_count, 2)
+        for call in mocked.call_args_list:
+            self.assertEqual(call[1]["backend"], "auto")
+        expected = numpy.median(numpy.array(images) - self.dark[:16, :8], axis=0)
+        numpy.testing.assert_array_almost_equal(result, expected, decimal=5)
+        self.assertRaises(RuntimeError, average.average_images, images, threshold=0, filter_="median", fformat=None, backend="foo")
+
     def test_quantile(self):
         shape = (100, 100)
         dtype = numpy.float32
@@ -153,6 +288,80 @@ class TestAverage(unittest.TestCase):
         result = algorith.get_result()
         numpy.testing.assert_array_almost_equal(result, (array1 + array2) * 0.5, decimal=3)
 
+    def test_reduce(self):
+        images = [numpy.random.random((2, 3)).astype(numpy.float32) for _ in range(4)]
+        for filter_class, expected in [(average.MaxAveraging, numpy.max(images, axis=0)),
+                                       (average.MinAveraging, numpy.min(images, axis=0)),
+                                       (average.SumAveraging, numpy.sum(images, axis=0)),
+                                       (average.MeanAveraging, numpy.mean(images, axis=0)),
+                                       (average.StdAveraging, numpy.std(images, axis=0))]:
+            algorith = filter_class()
+            algorith.init()
+            result = algorith.reduce(iter(images))
+            numpy.testing.assert_array_almost_equal(result, expected, decimal=5, err_msg=filter_class.name)
+            # images already added are kept
+            algorith.init()
+            algorith.add_image(images[0])
+            result = algorith.reduce(iter(images[1:]))
+            numpy.testing.assert_array_almost_equal(result, expected, decimal=5, err_msg=filter_class.name)
+
+    def test_observer(self):
+        images = [numpy.random.random((2, 3)).astype(numpy.float32) for _ in range(3)]
+        averager = average.Average()
+        averager.set_images(images)
+        algorithm = average.MeanAveraging()
+        averager.add_algorithm(algorithm)
+        observer = unittest.mock.Mock(spec=average.AverageObserver)
+        averager.set_observer(observer)
+        averager.process()
+        calls = [call[0] for call in observer.method_calls]
+        self.assertEqual(calls, ["process_started", "algorithm_started"] +
+                         ["frame_processed"] * 3 +
+                         ["result_processing", "algorithm_finished", "process_finished"])
+        observer.result_processing.assert_called_once_with(algorithm)
+
+    def test_std_filter(self):
+        algorith = average.StdAveraging()
+        # force several chunks of 3 images
+        algorith.max_chunk_size = 3 * 2 * 3 * 4
+        algorith.init()
+        images = [numpy.random.random((2, 3)) for _ in range(8)]
+        for image in images:
+            algorith.add_image(image)
+        result = algorith.get_result()
+        numpy.testing.assert_array_almost_equal(result, numpy.std(images, axis=0), decimal=5)
+
+    def test_stack_filter_partial(self):
+        """Less images than expected are provided to the stack"""
+        images = [numpy.random.random((4, 3)).astype(numpy.float32) for _ in range(3)]
+        for name, cutoff, expected in [("median", None, numpy.median(images, axis=0)),
+                                       ("mean", 10, numpy.mean(images, axis=0))]:
+            algorith = average.AverageDarkFilter(name, cutoff, None)
+            algorith.init(max_images=5)
+            for image in images:
+                algorith.add_image(image)
+            result = algorith.get_result()
+            numpy.testing.assert_array_almost_equal(result, expected, decimal=5)
+
+    def test_stack_filter_pixel_major(self):
+        """The stack is filled in the layout average_dark reduces, without
+        a copy of it"""
+        images = [numpy.random.random((4, 3)).astype(numpy.float32) for _ in range(7)]
+        for name, cutoff, expected in [("median", None, numpy.median(images, axis=0)),
+                                       ("quantiles", None, numpy.mean(numpy.sort(images, axis=0)[1:6], axis=0)),
+                                       ("max", None, numpy.max(images, axis=0))]:
+            algorith = average.AverageDarkFilter(name, cutoff, (0.2, 0.8))
+            self.assertEqual(algorith.pixel_major, name != "max")
+            # several flushes of the staged images, the last one partial
+            algorith.staging_size = 3
+            algorith.init(max_images=9)
+            for image in images:
+                algorith.add_image(image)
+            with unittest.mock.patch.object(average, "average_dark", wraps=average.average_dark) as mocked:
+                result = algorith.get_result()
+            self.assertEqual(mocked.call_args[1]["axis"], -1 if algorith.pixel_major else 0)
+            numpy.testing.assert_array_almost_equal(result, expected, decimal=5, err_msg=name)
+
     def test_average_monitor(self):
         data1 = numpy.array([[1.0, 3.0], [3.0, 4.0]])
         data2 = numpy.array([[2.0, 2.0], [1.0, 4.0]])
@@ -171,6 +380,78 @@ class TestAverage(unittest.TestCase):
         result = fabio.open(filename).data
         numpy.testing.assert_array_almost_equal(result, expected_result, decimal=3)
 
+    def test_corrected_image_preserves_input(self):
+        data = numpy.random.random((8, 4))
+        reference = data.copy()
+        result = average.average_images([data], darks=[self.dark[:8, :4]], threshold=0, filter_="max", fformat=None)
+        numpy.testing.assert_array_equal(data, reference)
+        numpy.testing.assert_array_almost_equal(result, data - self.dark[:8, :4], decimal=5)
+
+    def test_corrected_image_precision(self):
+        """Dark and flat corrections are computed in double precision"""
+        data = numpy.full((4, 3), 2 ** 24 + 1, dtype=numpy.float64)
+        dark = numpy.full((4, 3), 2 ** 24, dtype=numpy.float32)
+        data[1, 2] = numpy.nan
+        flat = numpy.full((4, 3), 0.5, dtype=numpy.float32)
+        result = average.average_images([data], darks=[dark], flats=[flat], threshold=0, filter_="max", fformat=None)
+        expected = numpy.full((4, 3), 2.0, dtype=numpy.float32)
+        # invalid pixels are propagated
+        expected[1, 2] = numpy.nan
+        numpy.testing.assert_array_equal(result, expected)
+
+    def test_correction_buffer_reuse(self):
+        dark = self.dark[:8, :4]
+        images = [numpy.random.random((8, 4)) for _ in range(3)]
+        corrected = numpy.array(images) - dark
+        for filter_, expected in [("max", corrected.max(axis=0)),
+                                  ("min", corrected.min(axis=0)),
+                                  ("sum", corrected.sum(axis=0)),
+                                  ("mean", corrected.mean(axis=0)),
+                                  ("median", numpy.median(corrected, axis=0))]:
+            result = average.average_images(images, darks=[dark], threshold=0, filter_=filter_, fformat=None)
+            numpy.testing.assert_array_almost_equal(result, expected, decimal=5, err_msg=filter_)
+
+    def test_monitor_cache(self):
+        image = fabio.numpyimage.numpyimage(numpy.ones((2, 2)))
+        image.header["mon"] = "2.0"
+        averager = average.Average()
+        averager.set_images([image])
+        averager.set_monitor_name("mon")
+        algorithms = [average.MaxAveraging(), average.MinAveraging()]
+        for algorithm in algorithms:
+            averager.add_algorithm(algorithm)
+        get_monitor_value = average.header_utils.get_monitor_value
+        with unittest.mock.patch.object(average.header_utils, "get_monitor_value", wraps=get_monitor_value) as mocked:
+            averager.process()
+        self.assertEqual(mocked.call_count, 1)
+        for algorithm in algorithms:
+            numpy.testing.assert_array_almost_equal(averager.get_image_reduction(algorithm), numpy.ones((2, 2)) / 2)
+
+    def test_monitor_cache_not_found(self):
+        """A multi-frame image without monitor is skipped frame per frame"""
+        missing = fabio.numpyimage.numpyimage(numpy.ones((3, 2, 2)))
+        image = fabio.numpyimage.numpyimage(numpy.ones((2, 2)))
+        image.header["mon"] = "4.0"
+        averager = average.Average()
+        averager.set_images([missing, image])
+        averager.set_monitor_name("mon")
+        algorithm = average.MaxAveraging()
+        averager.add_algorithm(algorithm)
+        get_monitor_value = average.header_utils.get_monitor_value
+        with unittest.mock.patch.object(average.header_utils, "get_monitor_value", wraps=get_monitor_value) as mocked:
+            averager.process()
+        self.assertEqual(mocked.call_count, 2)
+        numpy.testing.assert_array_almost_equal(averager.get_image_reduction(algorithm), numpy.ones((2, 2)) / 4)
+
+        # a new exception is raised each time
+        errors = []
+        for _ in range(2):
+            with self.assertRaises(average.header_utils.MonitorNotFound) as context:
+                averager._get_monitor(missing)
+            errors.append(context.exception)
+        self.assertIsNot(errors[0], errors[1])
+        self.assertEqual(str(errors[0]), str(errors[1]))
+
     def test_writed_properties(self):
         writer = average.MultiFilesAverageWriter("foo", "edf", dry_run=True)
         algorithm = average.AverageDarkFilter(filter_name="quantiles", cut_off=None, quantiles=(0.2, 0.8))
@@ -187,6 +468,46 @@ class TestAverage(unittest.TestCase):
         self.assertEqual(eval(header["cutoff"]), None)
         self.assertEqual(eval(header["quantiles"]), (0.2, 0.8))
 
+    def test_normalize_image_stack(self):
+        images = [numpy.random.random((8, 4)).astype(numpy.float64) for _ in range(3)]
+        stack, axis = average._normalize_image_stack(images)
+        self.assertEqual(stack.shape, (3, 8, 4))
+        self.assertEqual(stack.dtype, numpy.float32)
+        self.assertEqual(axis, 0)
+        numpy.testing.assert_array_almost_equal(stack[1], images[1])
+        stack, axis = average._normalize_image_stack(images, pixel_major=True)
+        self.assertEqual(stack.shape, (8, 4, 3))
+        self.assertEqual(stack.dtype, numpy.float32)
+        self.assertEqual(axis, -1)
+        numpy.testing.assert_array_almost_equal(stack[:, :, 1], images[1])
+
+        filenames = []
+        for i, image in enumerate(images):
+            filename = os.path.join(UtilsTest.tempdir, "testUtils_average_stack%i.edf" % i)
+            fabio.edfimage.edfimage(data=image.astype(numpy.float32)).write(filename)
+            filenames.append(filename)
+        for pixel_major in (False, True):
+            stack, axis = average._normalize_image_stack(filenames, pixel_major)
+            self.assertEqual(stack.dtype, numpy.float32)
+            numpy.testing.assert_array_almost_equal(numpy.moveaxis(stack, axis, 0)[2], images[2])
+
+        mixed, axis = average._normalize_image_stack([filenames[0], images[1]])
+        self.assertIsInstance(mixed, list)
+        self.assertEqual(len(mixed), 2)
+
+        # images of different shapes are rejected, given as arrays or files
+        filename = os.path.join(UtilsTest.tempdir, "testUtils_average_stack_other.edf")
+        fabio.edfimage.edfimage(data=numpy.zeros((4, 8), dtype=numpy.float32)).write(filename)
+        for pixel_major in (False, True):
+            self.assertRaises(Exception, average._normalize_image_stack, [images[0], numpy.zeros((4, 8))], pixel_major)
+            self.assertRaises(Exception, average._normalize_image_stack, [filenames[0], filename], pixel_major)
+
+    def test_common_prefix(self):
+        self.assertEqual(average.common_prefix(["dark_0001.edf", "dark_0002.edf", "dark_0010.edf"]), "dark_00")
+        self.assertEqual(average.common_prefix(["dark.edf", "flat.edf"]), "")
+        self.assertEqual(average.common_prefix(["dark.edf"]), "dark.edf")
+        self.assertEqual(average.common_prefix([]), "")
+
 
 class TestAverageAlgorithmFactory(unittest.TestCase):
 
@@ -198,6 +519,10 @@ class TestAverageAlgorithmFactory(unittest.TestCase):
         alrorithm = average.create_algorithm("sum")
         self.assertTrue(isinstance(alrorithm, average.SumAveraging))
 
+    def test_std(self):
+        alrorithm = average.create_algorithm("std")
+        self.assertTrue(isinstance(alrorithm, average.StdAveraging))
+
     def test_median(self):
         alrorithm = average.create_algorithm("median")
         self.assertTrue(isinstance(alrorithm, average.AverageDarkFilter))